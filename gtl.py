@@ -17,17 +17,18 @@ https://www.google.com/intl/en/policies/terms/
 """
 from __future__ import print_function
 
-from builtins import str
-from builtins import range
 import collections
+import collections.abc as _abc
 __author__ = 'Bruce Leban'
 
 # system modules
+import functools
 import html
 import logging
 import operator
 import os
 import pprint
+import re
 import sys
 
 # our modules
@@ -90,170 +91,741 @@ def ExpandTemplate(template, specials, params, name=''):
 
     {{#<comment>}}
   """
-  t = _ExpandBlocks(str(template), specials, params, name)
-  t = _ExpandVariables(t, specials, params, name)
-  return t
+  if type(template) is not str:
+    template = str(template)
+  out = []
+  _RenderInto(_CompileTemplate(template), specials, params, name, out)
+  return ''.join(out)
 
 
 BLOCK_OPEN = '[['
 END_BLOCK_OPEN = '[[/'
 BLOCK_CLOSE = ']]'
 
+VAR_OPEN = '{{'
+VAR_CLOSE = '}}'
 
-def _ExpandBlocks(template, specials, params, name):
-  """Expands all the blocks in a template."""
-  result = []
-  rest = template
-  while rest:
-    tag, before_tag, after_tag = _FindTag(rest, BLOCK_OPEN, BLOCK_CLOSE)
-    if tag is None:
-      break
-    end_tag = END_BLOCK_OPEN + tag + BLOCK_CLOSE
-    before_end = rest.find(end_tag, after_tag)
-    if before_end < 0:
-      break
-    after_end = before_end + len(end_tag)
+FOR_TAG = 'for'
+IF_TAG = 'if'
+INCLUDE_TAG = 'include'
 
-    result.append(rest[:before_tag])
-    block = rest[after_tag:before_end]
-    result.append(_ExpandBlock(tag, block, specials, params, name))
-    rest = rest[after_end:]
-  return ''.join(result) + rest
+# Finds the start of the next tag of either kind.
+_TAG_OPEN_RE = re.compile(
+    '%s|%s' % (re.escape(BLOCK_OPEN), re.escape(VAR_OPEN)))
+
+# The data is almost always plain dicts and lists, which are tested for
+# with type() first; these ABCs are only the fallback for anything else.
+_Mapping = _abc.Mapping
+_Sequence = _abc.Sequence
+
+
+# A compiled template is a _Template holding a tuple of nodes: plain strings
+# for literal text, _Variable for {{...}} tags and one of the block types for
+# [[...]] tags. If rescan is set, some literal text before a block ends inside
+# an unterminated variable tag, so variables have to be expanded over the
+# whole output just as the uncompiled template would be. If the template is
+# nothing but literal text and comments, and the text cannot form a variable
+# tag with the text around it, text is the text it expands to and it can be
+# output as it is.
+#
+# A _Variable's path is a tuple of (kind, field, index) triples, one for each
+# .-separated field, where kind is one of the _FIELD_* constants below and
+# index is the field as an int for _FIELD_INDEX. It is looked up starting
+# from the value selected by
+# its root (one of the _ROOT_* constants). For _ROOT_SPECIALS, special
+# is the first field, which is looked up directly in the specials dict and
+# is not part of the path. If the path is all _FIELD_NAME fields, getter looks
+# the whole path up in one call. Its escaper is the function from _ESCAPERS
+# named by the :<escaper> suffix, if any.
+_Variable = collections.namedtuple(
+    '_Variable',
+    ['source', 'is_comment', 'inverted', 'root', 'special', 'path',
+     'getter', 'escaper'])
+_IfBlock = collections.namedtuple('_IfBlock', ['var', 'body'])
+_ForBlock = collections.namedtuple('_ForBlock', ['tag', 'var', 'body'])
+_IncludeBlock = collections.namedtuple(
+    '_IncludeBlock', ['filename', 'path', 'body'])
+
+
+class _Template(object):
+  """A compiled template (see above)."""
+
+  __slots__ = ('nodes', 'rescan', 'text', 'render')
+
+  def __init__(self, nodes, rescan, text):
+    self.nodes = nodes
+    self.rescan = rescan
+    self.text = text
+    self.render = None  # generated by _RenderInto when first needed
+
+# The roots of variables; _ROOT_KEY and _ROOT_PARAMS are indexes into
+# (name, params).
+_ROOT_KEY = 0  # _key
+_ROOT_PARAMS = 1  # _this and fields that do not start with '_'
+_ROOT_SPECIALS = 2  # all other fields that start with '_'
+
+# The kinds of fields in the path of a variable.
+_FIELD_NAME = 0  # a key in a mapping
+_FIELD_INDEX = 1  # a number: an index into a sequence or a key in a mapping
+_FIELD_DEREF = 2  # *<param>: a key given by the value of a parameter
+
+# The keys of the first iterations of a for loop over a sequence.
+_SMALL_INT_STR = tuple(str(i) for i in range(256))
+
+# Included files, keyed by path: (modification time, source, template).
+_INCLUDE_CACHE = {}
+
+# If set, included files are checked on every expansion and reloaded if they
+# have changed. Clear it to skip the check if the resources never change.
+_RELOAD_INCLUDES = True
+
+
+@functools.lru_cache(maxsize=512)
+def _CompileTemplate(template):
+  """Compiles a template, caching the result.
+
+  Templates are static files, so each one is only parsed once rather than
+  on every expansion.
+  """
+  return _Compile(template)
 
 
-VAR_OPEN = '{{'
-VAR_CLOSE = '}}'
+def _Compile(template, start=0, end=None):
+  """Compiles all the blocks and variables in template[start:end].
+
+  This is a single pass over the template: each step searches for the next
+  opening marker of either kind and the template is walked by index rather
+  than by slicing off the part that has been handled.
+
+  Tags are matched the same way as they always have been. Blocks are found
+  first, so a variable tag never extends into a block; and if a block has no
+  matching end tag, the rest of the template is searched only for variables.
+  """
+  if end is None:
+    end = len(template)
+  nodes = []
+  rescan = False
+  pos = start
+  text_start = start  # the start of text not yet added to nodes
+  find_blocks = True
+  find_variables = True
+  while find_blocks or find_variables:
+    if find_blocks and find_variables:
+      match = _TAG_OPEN_RE.search(template, pos, end)
+      if match is None:
+        break
+      open_pos = match.start()
+      is_block = match.group() == BLOCK_OPEN
+    else:
+      is_block = find_blocks
+      open_pos = template.find(BLOCK_OPEN if is_block else VAR_OPEN, pos, end)
+      if open_pos < 0:
+        break
+
+    if is_block:
+      block = _FindBlock(template, open_pos, end)
+      if block is None:
+        find_blocks = False
+        continue
+      tag, after_tag, before_end, after_end = block
+      if open_pos > text_start:
+        nodes.append(template[text_start:open_pos])
+      rescan = rescan or _IsOpenEnded(template, text_start, open_pos)
+      block = _CompileBlock(tag, template, after_tag, before_end)
+      if block is not None:
+        nodes.append(block)
+      pos = text_start = after_end
+      continue
+
+    close_pos = template.find(VAR_CLOSE, open_pos, end)
+    if close_pos < 0:
+      find_variables = False
+      continue
+    if find_blocks:
+      block_pos = template.find(BLOCK_OPEN, open_pos, close_pos)
+      if block_pos >= 0:
+        if _FindBlock(template, block_pos, end) is not None:
+          pos = block_pos  # the variable tag is cut off by the block
+          continue
+        find_blocks = False
+    if open_pos > text_start:
+      nodes.append(template[text_start:open_pos])
+    nodes.append(_ParseVariable(template[open_pos + len(VAR_OPEN):close_pos]))
+    pos = text_start = close_pos + len(VAR_CLOSE)
+  if end > text_start:
+    nodes.append(template[text_start:end])
+
+  text = None
+  if not rescan and all(
+      type(node) is str or type(node) is _Variable and node.is_comment
+      for node in nodes):
+    text = ''.join(node for node in nodes if type(node) is str)
+    if _IsOpenEnded(text):
+      text = None
+  return _Template(tuple(nodes), rescan, text)
+
+
+def _FindBlock(template, open_pos, end):
+  """Finds the block whose start tag starts at open_pos.
+
+  Returns:
+    (tag, after_tag, before_end, after_end) where template[after_tag:
+    before_end] is the body of the block and template[before_end:after_end]
+    is its end tag, or None if the block is not closed.
+  """
+  close_pos = template.find(BLOCK_CLOSE, open_pos, end)
+  if close_pos < 0:
+    return None
+  tag = template[open_pos + len(BLOCK_OPEN):close_pos]
+  after_tag = close_pos + len(BLOCK_CLOSE)
+  end_tag = END_BLOCK_OPEN + tag + BLOCK_CLOSE
+  before_end = template.find(end_tag, after_tag, end)
+  if before_end < 0:
+    return None
+  return (tag, after_tag, before_end, before_end + len(end_tag))
+
+
+def _CompileBlock(tag, template, start, end):
+  """Compiles a single template block whose body is template[start:end]."""
+  tag_type, _, block_var = tag.partition(':')
+  if tag_type == INCLUDE_TAG:
+    # replace /s with local file system equivalent
+    path = os.sep + block_var.replace('/', os.sep)
+    return _IncludeBlock(block_var, path, _Compile(template, start, end))
+  elif tag_type == IF_TAG:
+    return _IfBlock(_ParseVariable(block_var), _Compile(template, start, end))
+  elif tag_type == FOR_TAG:
+    return _ForBlock(tag, _ParseVariable(block_var),
+                     _Compile(template, start, end))
+  else:
+    _Log('Error: Invalid block: %s', tag)
+    return None
+
+
+def _ParseVariable(var):
+  """Parses the <field>.<field>...[:<escaper>] syntax of a variable."""
+  source = VAR_OPEN + var + VAR_CLOSE
+  if var.startswith('#'):  # this is a comment.
+    return _Variable(source, True, False, _ROOT_PARAMS, None, (), None,
+                     None)
+
+  # Strip out leading ! which negates value
+  inverted = var.startswith('!')
+  if inverted:
+    var = var[1:]
+
+  # Strip out trailing :<escaper>
+  escaper_name = None
+  if var.find(':') >= 0:
+    (var, escaper_name) = var.split(':', 1)
+
+  fields = var.split('.')
+  special = None
+  if var == '_key':
+    root = _ROOT_KEY
+    fields = []
+  elif var == '_this':
+    root = _ROOT_PARAMS
+    fields = []
+  elif var.startswith('_'):
+    root = _ROOT_SPECIALS
+    special = fields.pop(0)
+  else:
+    root = _ROOT_PARAMS
+  path = tuple(_ParseField(field) for field in fields)
+  return _Variable(source, False, inverted, root, special, path,
+                   _CompileGetter(path), _ESCAPERS.get(escaper_name))
+
+
+def _ParseField(field):
+  """Parses a single field of a variable into a (kind, field, index)."""
+  if field.startswith('*'):
+    return (_FIELD_DEREF, field, None)
+  if field.isdigit():
+    try:
+      return (_FIELD_INDEX, field, int(field))
+    except ValueError:
+      pass
+  return (_FIELD_NAME, field, None)
+
+
+def _CompileGetter(path):
+  """Makes a function that looks up a path of _FIELD_NAME fields.
+
+  The function raises KeyError or TypeError if a field is missing or a value
+  along the path is not a mapping.
+
+  Returns:
+    the function or None if the path is empty or has other kinds of fields.
+  """
+  if not path or any(kind != _FIELD_NAME for kind, _, _ in path):
+    return None
+  getters = [operator.itemgetter(field) for _, field, _ in path]
+  if len(getters) == 1:
+    return getters[0]
+  elif len(getters) == 2:
+    first, second = getters
+    return lambda value: second(first(value))
+  keys = tuple(field for _, field, _ in path)
+
+  def Getter(value):
+    for key in keys:
+      value = value[key]
+    return value
+  return Getter
+
+
+def _IsOpenEnded(text, start=0, end=None):
+  """Checks if text[start:end] ends inside a variable tag.
+
+  That is, whether text following it could close a variable tag that was
+  opened inside it.
+  """
+  if end is None:
+    end = len(text)
+  close_pos = text.rfind(VAR_CLOSE, start, end)
+  if close_pos >= 0:
+    start = close_pos + len(VAR_CLOSE)
+  return (text.find(VAR_OPEN, start, end) >= 0 or
+          text.endswith(VAR_OPEN[0], start, end))
+
+
+def _RenderInto(compiled, specials, params, name, out):
+  """Expands a compiled template, appending the output to the list out.
+
+  Nested blocks append to the same list, so only the top level joins the
+  output. Block output is expanded again for variables in this scope, the
+  same as for an uncompiled template.
+  """
+  render = compiled.render
+  if render is None:
+    render = compiled.render = _GenerateRenderer(compiled)
+  render(specials, params, name, out)
+
+
+# How many levels of nested blocks are expanded by one generated function.
+# Python limits how deeply statements can be nested within a function and
+# each level takes two (the if or for and a try), so blocks nested more
+# deeply than this call the generated function for their body instead.
+_MAX_INLINE_DEPTH = 6
+
+
+class _Rescan(Exception):
+  """Raised in generated code if a template needs _RenderSource instead."""
+
+
+def _GenerateRenderer(compiled):
+  """Generates a Python function that expands a compiled template.
+
+  The function has the same arguments as _RenderInto. Its code appends the
+  text and expands the variables and blocks of the template in order, so
+  expanding the template does not walk the compiled nodes at all. All the
+  text and field names it uses are passed to it as globals; none of the
+  template is ever written into the generated source.
+  """
+  generator = _RendererGenerator()
+  generator.Template(compiled, 'params', 'name', 0, 1)
+  source = '\n'.join(['def Render(specials, params, name, out):',
+                      '  append = out.append'] + generator.lines)
+  namespace = generator.namespace
+  exec(compile(source + '\n', '<gtl template>', 'exec'), namespace)
+  return namespace['Render']
+
+
+class _RendererGenerator(object):
+  """Generates the body of a function that expands a compiled template."""
+
+  def __init__(self):
+    self.lines = []
+    self.namespace = {
+        '_DerefField': _DerefField,
+        '_ExpandBlockOutput': _ExpandBlockOutput,
+        '_ExpandInclude': _ExpandInclude,
+        '_ExpandVariables': _ExpandVariables,
+        '_ForItems': _ForItems,
+        '_GetValue': _GetValue,
+        '_Rescan': _Rescan,
+        '_RenderInto': _RenderInto,
+        '_RenderSource': _RenderSource,
+    }
+
+  def _Emit(self, indent, line):
+    self.lines.append('  ' * indent + line)
+
+  def _Constant(self, value):
+    """Makes value available to the generated code and returns its name."""
+    name = '_c%d' % len(self.namespace)
+    self.namespace[name] = value
+    return name
+
+  def Template(self, compiled, params, name, depth, indent):
+    """Generates code to expand a compiled template.
+
+    Args:
+      compiled: the compiled template.
+      params: the name of the variable holding the parameter values.
+      name: the name of the variable holding the name of the _this object.
+      depth: the number of blocks this template is nested in.
+      indent: the indentation of the code.
+
+    Returns:
+      True if the output is always plain text.
+    """
+    if compiled.text is not None:
+      if compiled.text:
+        self._Emit(indent, 'append(%s)' % self._Constant(compiled.text))
+      return True
+    if compiled.rescan and depth == 0:
+      self._EmitRenderSource(compiled, params, name, indent)
+      return False
+    if compiled.rescan or depth >= _MAX_INLINE_DEPTH:
+      self._Emit(indent, '_RenderInto(%s, specials, %s, %s, out)' %
+                 (self._Constant(compiled), params, name))
+      return False
+
+    start = len(self.lines)
+    rescans = False
+    text = []  # literal text not yet appended
+    for node in compiled.nodes:
+      if type(node) is str:
+        text.append(node)
+        continue
+      elif type(node) is _Variable and node.is_comment:
+        continue  # comments expand to nothing, so text runs on past them
+      if text:
+        self._Emit(indent + 1,
+                   'append(%s)' % self._Constant(''.join(text)))
+        text = []
+      if type(node) is _Variable:
+        self.Variable(node, params, name, indent + 1)
+      elif self.Block(node, params, name, depth, indent + 1):
+        rescans = True
+    if text:
+      self._Emit(indent + 1, 'append(%s)' % self._Constant(''.join(text)))
+    lines = self.lines[start:]
+    del self.lines[start:]
+    if not rescans:
+      self.lines.extend(line[2:] for line in lines)
+      return False
+
+    self._Emit(indent, 'start%d = len(out)' % depth)
+    self._Emit(indent, 'try:')
+    self.lines.extend(lines)
+    self._Emit(indent, 'except _Rescan:')
+    self._Emit(indent + 1, 'del out[start%d:]' % depth)
+    self._EmitRenderSource(compiled, params, name, indent + 1)
+    return False
+
+  def _EmitRenderSource(self, compiled, params, name, indent):
+    self._Emit(indent, 'source = _RenderSource(%s, specials, %s, %s)' %
+               (self._Constant(compiled.nodes), params, name))
+    self._Emit(indent, 'append(_ExpandVariables(source, specials, %s, %s))' %
+               (params, name))
+
+  def Block(self, block, params, name, depth, indent):
+    """Generates code to expand a block.
+
+    Returns:
+      True if the code raises _Rescan when the block's output can't be
+      expanded for variables on its own.
+    """
+    mark = 'mark%d' % depth
+    if type(block) is _IncludeBlock:
+      self._Emit(indent, '%s = len(out)' % mark)
+      self._Emit(indent, 'if not _ExpandInclude(%s, specials, %s, %s, out):' %
+                 (self._Constant(block), params, name))
+      indent += 1
+    else:
+      self.Value(block.var, params, name, indent)
+      self._Emit(indent, '%s = len(out)' % mark)
+      start = len(self.lines)
+      if type(block) is _IfBlock:
+        self._Emit(indent, 'if v:')
+        plain = self.Template(block.body, params, name, depth + 1, indent + 1)
+      else:
+        item_params = 'params%d' % (depth + 1)
+        item_name = 'name%d' % (depth + 1)
+        self._Emit(indent, 'for %s, %s in _ForItems(%s, v):' %
+                   (item_name, item_params, self._Constant(block.tag)))
+        self.Template(block.body, item_params, item_name, depth + 1,
+                      indent + 1)
+        plain = False
+      if len(self.lines) == start + 1:
+        self._Emit(indent + 1, 'pass')
+      if plain:
+        return False
+    self._Emit(indent, 'if not _ExpandBlockOutput(out, %s, specials, %s, %s):'
+               % (mark, params, name))
+    self._Emit(indent + 1, 'raise _Rescan')
+    return True
+
+  def Variable(self, var, params, name, indent):
+    """Generates code to expand a variable and append it to the output."""
+    self.Value(var, params, name, indent)
+    if var.escaper is not None:
+      self._Emit(indent, 'append(v)')
+    elif var.inverted:
+      self._Emit(indent, 'append(str(v))')
+    else:
+      self._Emit(indent, "append(v if type(v) is str else "
+                 "'' if v is None else str(v))")
+
+  def Value(self, var, params, name, indent):
+    """Generates code to set v to the value of a variable.
+
+    This is the same as _ExpandVariable except that it may leave v None.
+    """
+    if var.is_comment:
+      self._Emit(indent, "v = ''")
+      return
+    if var.root == _ROOT_SPECIALS:
+      self._Emit(indent, "v = specials.get(%s, '')" %
+                 self._Constant(var.special))
+    elif var.root == _ROOT_KEY:
+      self._Emit(indent, 'v = %s' % name)
+    else:
+      self._Emit(indent, 'v = %s' % params)
+
+    if var.getter is not None:
+      self._Emit(indent, 'try:')
+      self._Emit(indent + 1, 'v = v' + ''.join(
+          '[%s]' % self._Constant(field) for _, field, _ in var.path))
+      self._Emit(indent, 'except (KeyError, TypeError):')
+      self._Emit(indent + 1, "v = ''")
+    else:
+      for kind, field, index in var.path:
+        field = self._Constant(field)
+        if kind == _FIELD_NAME:
+          self._Emit(indent, "v = (v.get(%s, '') if type(v) is dict else "
+                     "_GetValue(v, %s, ''))" % (field, field))
+        elif kind == _FIELD_INDEX:
+          self._Emit(indent, "v = ((v[%d] if %d < len(v) else '')"
+                     " if type(v) is list else _GetValue(v, %s, ''))" %
+                     (index, index, field))
+        else:
+          self._Emit(indent, "v = _GetValue(v, _DerefField(%s, specials, %s),"
+                     " '')" % (field, params))
+
+    if var.inverted:
+      self._Emit(indent, 'v = not v')
+    if var.escaper is not None:
+      self._Emit(indent, 'v = %s(v)' % self._Constant(var.escaper))
+
+
+def _ExpandBlockOutput(out, mark, specials, params, name):
+  """Expands the variables in the output of a block, out[mark:].
+
+  Returns:
+    False if the block's output ends inside an unterminated variable tag, in
+    which case the template has to be expanded with _RenderSource instead.
+  """
+  for i in range(mark, len(out)):
+    if VAR_OPEN[0] in out[i]:
+      break
+  else:
+    return True  # no variables to expand in the block output
+  block = ''.join(out[mark:])
+  del out[mark:]
+  if _IsOpenEnded(block):
+    return False
+  out.append(_ExpandVariables(block, specials, params, name))
+  return True
+
+
+def _RenderSource(nodes, specials, params, name):
+  """Expands the blocks of a compiled template but leaves variable tags."""
+  result = []
+  for node in nodes:
+    if type(node) is str:
+      result.append(node)
+    elif type(node) is _Variable:
+      result.append(node.source)
+    else:
+      block = []
+      _ExpandBlock(node, specials, params, name, block)
+      result.append(''.join(block))
+  return ''.join(result)
 
 
 def _ExpandVariables(template, specials, params, name):
   """Expands all the variables in a template."""
+  if VAR_OPEN not in template:
+    return template
   result = []
-  rest = template
-  while rest:
-    tag, before_tag, after_tag = _FindTag(rest, VAR_OPEN, VAR_CLOSE)
+  pos = 0
+  end = len(template)
+  while pos < end:
+    tag, before_tag, after_tag = _FindTag(template, VAR_OPEN, VAR_CLOSE,
+                                          pos, end)
     if tag is None:
       break
-    result.append(rest[:before_tag])
-    result.append(str(_ExpandVariable(tag, specials, params, name)))
-    rest = rest[after_tag:]
-  return ''.join(result) + rest
+    result.append(template[pos:before_tag])
+    value = _ExpandVariable(_ParseVariable(tag), specials, params, name)
+    result.append(value if type(value) is str else str(value))
+    pos = after_tag
+  result.append(template[pos:])
+  return ''.join(result)
 
 
-FOR_TAG = 'for'
-IF_TAG = 'if'
-INCLUDE_TAG = 'include'
+def _ExpandBlock(block, specials, params, name, out):
+  """Expands a single compiled template block into out."""
+  if type(block) is _IncludeBlock:
+    _ExpandInclude(block, specials, params, name, out)
+  elif type(block) is _IfBlock:
+    block_data = _ExpandVariable(block.var, specials, params, name)
+    if block_data:
+      _RenderInto(block.body, specials, params, name, out)
+  else:
+    block_data = _ExpandVariable(block.var, specials, params, name)
+    for k, v in _ForItems(block.tag, block_data):
+      _RenderInto(block.body, specials, v, k, out)
 
 
-def _ExpandBlock(tag, template, specials, params, name):
-  """Expands a single template block."""
+def _ExpandInclude(block, specials, params, name, out):
+  """Expands an include block (or insert the template on an error).
 
-  tag_type, block_var = tag.split(':', 1)
-  if tag_type == INCLUDE_TAG:
-    return _ExpandInclude(tag, block_var, template, specials, params, name)
-  elif tag_type == IF_TAG:
-    block_data = _ExpandVariable(block_var, specials, params, name)
-    if block_data:
-      return ExpandTemplate(template, specials, params, name)
-    return ''
-  elif tag_type == FOR_TAG:
-    block_data = _ExpandVariable(block_var, specials, params, name)
-    return _ExpandFor(tag, template, specials, block_data)
-  else:
-    _Log('Error: Invalid block: %s' % (tag,))
-    return ''
+  Returns:
+    True if the output is known to be plain text which does not need its
+    variables expanded again.
+  """
+  compiled = _LoadInclude(block.path)
+  if compiled is None:
+    _Log('Error: missing filename: %s', block.filename)
+    compiled = block.body
+  _RenderInto(compiled, specials, params, name, out)
+  return compiled.text is not None
+
+
+def _LoadInclude(fname):
+  """Gets the compiled template for an included file.
 
+  Args:
+    fname: the path of the file within the resource directory.
+
+  Returns:
+    the compiled template or None if the file cannot be opened.
+  """
+  entry = _INCLUDE_CACHE.get(fname)
+  if entry is not None and not _RELOAD_INCLUDES:
+    return entry[2]
+  try:
+    mtime = os.stat(gruyere.RESOURCE_PATH + fname).st_mtime
+  except OSError:
+    return None
+  if entry is not None and entry[0] == mtime:
+    return entry[2]
 
-def _ExpandInclude(_, filename, template, specials, params, name):
-  """Expands an include block (or insert the template on an error)."""
-  result = ''
-  # replace /s with local file system equivalent
-  fname = os.sep + filename.replace('/', os.sep)
   f = None
   try:
     try:
       f = gruyere._Open(gruyere.RESOURCE_PATH, fname)
       result = f.read()
     except IOError:
-      _Log('Error: missing filename: %s' % (filename,))
-      result = template
+      return None
   finally:
     if f: f.close()
-  return ExpandTemplate(result, specials, params, name)
-
-
-def _ExpandFor(tag, template, specials, block_data):
-  """Expands a for block iterating over the block_data."""
-  result = []
-  if isinstance(block_data, collections.Mapping):
-    for v in block_data:
-      result.append(ExpandTemplate(template, specials, block_data[v], v))
-  elif isinstance(block_data, collections.Sequence):
-    for i in range(len(block_data)):
-      result.append(ExpandTemplate(template, specials, block_data[i], str(i)))
+  if entry is not None and entry[1] == result:
+    compiled = entry[2]  # touched but not changed
   else:
-    _Log('Error: Invalid type: %s' % (tag,))
-    return ''
-  return ''.join(result)
+    compiled = _Compile(result)
+  _INCLUDE_CACHE[fname] = (mtime, result, compiled)
+  return compiled
+
+
+def _ForItems(tag, block_data):
+  """Gets the (key, value) pairs a for block iterates over."""
+  if type(block_data) is dict or (type(block_data) is not list and
+                                  isinstance(block_data, _Mapping)):
+    return block_data.items()
+  elif type(block_data) is list or isinstance(block_data, _Sequence):
+    if len(block_data) <= len(_SMALL_INT_STR):
+      return zip(_SMALL_INT_STR, block_data)
+    return [(str(i), v) for i, v in enumerate(block_data)]
+  else:
+    _Log('Error: Invalid type: %s', tag)
+    return ()
 
 
 def _ExpandVariable(var, specials, params, name, default=''):
   """Gets a variable value."""
-  if var.startswith('#'):  # this is a comment.
+  if var.is_comment:
     return ''
 
-  # Strip out leading ! which negates value
-  inverted = var.startswith('!')
-  if inverted:
-    var = var[1:]
-
-  # Strip out trailing :<escaper>
-  escaper_name = None
-  if var.find(':') >= 0:
-    (var, escaper_name) = var.split(':', 1)
-
   value = _ExpandValue(var, specials, params, name, default)
-  if inverted:
+  if var.inverted:
     value = not value
 
-  if escaper_name == 'text':
-    value = html.escape(str(value))
-  elif escaper_name == 'html':
-    value = sanitize.SanitizeHtml(str(value))
-  elif escaper_name == 'pprint':  # for debugging
-    value = '<pre>' + cgi.escape(pprint.pformat(value)) + '</pre>'
+  if var.escaper is not None:
+    value = var.escaper(value)
 
   if value is None:
     value = ''
   return value
 
 
+def _EscapeText(value):
+  return html.escape(str(value))
+
+
+def _EscapeHtml(value):
+  return sanitize.SanitizeHtml(str(value))
+
+
+def _EscapePrettyPrint(value):  # for debugging
+  return '<pre>' + html.escape(pprint.pformat(value)) + '</pre>'
+
+
+_ESCAPERS = {
+    'text': _EscapeText,
+    'html': _EscapeHtml,
+    'pprint': _EscapePrettyPrint,
+}
+
+
 def _ExpandValue(var, specials, params, name, default):
   """Expand one value.
 
   This expands the <field>.<field>...<field> part of the variable
-  expansion. A field may be of the form *<param> to use the value
-  of a parameter as the field name.
+  expansion, using the path parsed by _ParseVariable. A field may be of the
+  form *<param> to use the value of a parameter as the field name.
   """
-  if var == '_key':
-    return name
-  elif var == '_this':
-    return params
-  if var.startswith('_'):
-    value = specials
+  if var.root == _ROOT_SPECIALS:
+    value = specials.get(var.special, default)
   else:
-    value = params
-
-  for v in var.split('.'):
-    if v == '*_this':
-      v = params
-    if v.startswith('*'):
-      v = _GetValue(specials['_params'], v[1:])
-      if isinstance(v, collections.Sequence):
-        v = v[0]  # reduce repeated url param to single value
-    value = _GetValue(value, str(v), default)
+    value = (name, params)[var.root]
+  if var.getter is not None:
+    try:
+      return var.getter(value)
+    except (KeyError, TypeError):
+      return default
+
+  for kind, field, index in var.path:
+    if kind == _FIELD_NAME:
+      if type(value) is dict:
+        value = value.get(field, default)
+      else:
+        value = _GetValue(value, field, default)
+    elif kind == _FIELD_INDEX:
+      if type(value) is list:
+        value = value[index] if index < len(value) else default
+      else:
+        value = _GetValue(value, field, default)
+    else:
+      value = _GetValue(value, _DerefField(field, specials, params), default)
   return value
 
 
+def _DerefField(field, specials, params):
+  """Gets the field name that a *<param> field refers to."""
+  if field == '*_this':
+    field = params
+  if field.startswith('*'):
+    field = _GetValue(specials['_params'], field[1:])
+    if type(field) is list or isinstance(field, _Sequence):
+      field = field[0]  # reduce repeated url param to single value
+  return str(field)
+
+
 def _GetValue(collection, index, default=''):
   """Gets a single indexed value out of a collection.
 
@@ -263,9 +835,18 @@ def _GetValue(collection, index, default=''):
   Returns:
     value
   """
-  if isinstance(collection, collections.Mapping) and index in collection:
+  if type(collection) is dict:
+    return collection.get(index, default)
+  elif type(collection) is list:
+    if index.isdigit():
+      i = int(index)
+      if i < len(collection):
+        return collection[i]
+    return default
+
+  if isinstance(collection, _Mapping) and index in collection:
     value = collection[index]
-  elif (isinstance(collection, collections.Sequence) and index.isdigit() and
+  elif (isinstance(collection, _Sequence) and index.isdigit() and
         int(index) < len(collection)):
     value = collection[int(index)]
   else:
@@ -281,28 +862,40 @@ def _Cond(test, if_true, if_false):
     return if_false
 
 
-def _FindTag(template, open_marker, close_marker):
+def _FindTag(template, open_marker, close_marker, start=0, end=None):
   """Finds a single tag.
 
   Args:
     template: the template to search.
     open_marker: the start of the tag (e.g., '{{').
     close_marker: the end of the tag (e.g., '}}').
+    start: where to start searching.
+    end: where to stop searching (defaults to the end of the template).
 
   Returns:
     (tag, pos1, pos2) where the tag has the open and close markers
     stripped off and pos1 is the start of the tag and pos2 is the end of
     the tag. Returns (None, None, None) if there is no tag found.
   """
-  open_pos = template.find(open_marker)
-  close_pos = template.find(close_marker, open_pos)
-  if open_pos < 0 or close_pos < 0 or open_pos > close_pos:
+  if end is None:
+    end = len(template)
+  open_pos = template.find(open_marker, start, end)
+  if open_pos < 0:
+    return (None, None, None)
+  close_pos = template.find(close_marker, open_pos, end)
+  if close_pos < 0:
     return (None, None, None)
   return (template[open_pos + len(open_marker):close_pos],
           open_pos,
           close_pos + len(close_marker))
 
 
-def _Log(message):
-  logging.warning('%s', message)
-  print(message, file=sys.stderr)
+# Set to True to also print logged errors directly to stderr.
+_DEBUG = False
+
+
+def _Log(message, *args):
+  """Logs an error; message is only formatted with args if it is output."""
+  logging.warning(message, *args)
+  if _DEBUG:
+    print(message % args, file=sys.stderr)